@@ -1,76 +1,256 @@
+import mmap
 import os
 import subprocess
 import re
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from urllib.parse import quote
+import requests
 from github import Github
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 token = os.environ["GITHUB_TOKEN"]
 repo_name = os.environ["REPO_NAME"]
 pr_number = int(os.environ["PR_NUMBER"])
 branch = os.environ["BRANCH_NAME"]
 pr_title = os.environ["PR_TITLE"]
+base_branch = os.environ["BASE_BRANCH"]
 
-EXPECTED_LABELS = set()
+_ISSUE_RE = re.compile(r"[A-Z]{2,6}-\d+")
+_CACHE_PATTERN = "@cachea?ble"
+_CACHE_RE_B = re.compile(rb"@cachea?ble", re.IGNORECASE)
+_GREP_BATCH_SIZE = 500
 
+SUFFIX_LABELS = {
+    ".impex": "IMPEX",
+    "-items.xml": "ITEMS"
+}
+TRACKED_SUFFIXES = (".java", *SUFFIX_LABELS)
+SYSTEM_LABELS = frozenset({"IMPEX", "CACHE", "ITEMS", "conflict"})
+
+API_URL = "https://api.github.com"
+API_TIMEOUT = 15
+API_RETRY = Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504], allowed_methods=None)
+
+session = requests.Session()
+session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=API_RETRY))
+session.headers.update({
+    "Authorization": f"token {token}",
+    "Accept": "application/vnd.github.v3+json"
+})
+
+PR_METADATA_QUERY = """
+query($owner: String!, $name: String!, $number: Int!) {
+  repository(owner: $owner, name: $name) {
+    labels(first: 100) {
+      nodes { name }
+      pageInfo { hasNextPage endCursor }
+    }
+    milestones(first: 100, states: [OPEN, CLOSED]) {
+      nodes { number title }
+      pageInfo { hasNextPage endCursor }
+    }
+    pullRequest(number: $number) {
+      labels(first: 100) {
+        nodes { name }
+        pageInfo { hasNextPage endCursor }
+      }
+      milestone { number title }
+    }
+  }
+}
+"""
+
+REPO_LABELS_QUERY = """
+query($owner: String!, $name: String!, $cursor: String) {
+  repository(owner: $owner, name: $name) {
+    labels(first: 100, after: $cursor) {
+      nodes { name }
+      pageInfo { hasNextPage endCursor }
+    }
+  }
+}
+"""
+
+MILESTONES_QUERY = """
+query($owner: String!, $name: String!, $cursor: String) {
+  repository(owner: $owner, name: $name) {
+    milestones(first: 100, after: $cursor, states: [OPEN, CLOSED]) {
+      nodes { number title }
+      pageInfo { hasNextPage endCursor }
+    }
+  }
+}
+"""
+
+PR_LABELS_QUERY = """
+query($owner: String!, $name: String!, $number: Int!, $cursor: String) {
+  repository(owner: $owner, name: $name) {
+    pullRequest(number: $number) {
+      labels(first: 100, after: $cursor) {
+        nodes { name }
+        pageInfo { hasNextPage endCursor }
+      }
+    }
+  }
+}
+"""
+
+@lru_cache(maxsize=4)
 def get_changed_files(base_branch):
     result = subprocess.run(
-        ["git", "diff", "--name-status", f"origin/{base_branch}...HEAD"],
+        ["git", "diff", "--name-status", f"origin/{base_branch}...HEAD", "--", "*.java", "*.impex", "*-items.xml"],
         capture_output=True, text=True
     )
     files = []
-    for line in result.stdout.strip().splitlines():
-        if "\t" in line:
-            status, path = line.split('\t', 1)
-            files.append((status, path))
-    return files
+    for line in result.stdout.splitlines():
+        status, sep, paths = line.partition("\t")
+        if sep:
+            # Renames and copies list the old and new path; only the new one exists.
+            files.append((status, paths.rpartition("\t")[2]))
+    return tuple(files)
 
-def check_label_conditions(files):
-    has_impex = False
-    has_items = False
-    has_cache = False
+@lru_cache(maxsize=4)
+def get_commit_subjects(base_branch):
+    result = subprocess.run(
+        ["git", "log", f"origin/{base_branch}..HEAD", "--pretty=format:%s"],
+        capture_output=True, text=True
+    )
+    return tuple(result.stdout.splitlines())
+
+def scan_files_for_cache(java_files):
+    for file in java_files:
+        try:
+            with open(file, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as content:
+                if _CACHE_RE_B.search(content):
+                    return True
+        except (OSError, ValueError):
+            continue
+    return False
+
+def has_cache_annotation(java_files):
+    for i in range(0, len(java_files), _GREP_BATCH_SIZE):
+        batch = java_files[i:i + _GREP_BATCH_SIZE]
+        result = subprocess.run(
+            ["git", "--literal-pathspecs", "grep", "-q", "-i", "-E", _CACHE_PATTERN, "--"] + batch,
+            capture_output=True
+        )
+        if result.returncode == 0:
+            return True
+        if result.returncode != 1 and scan_files_for_cache(batch):
+            return True
+    return False
+
+def check_label_conditions(files, branch):
+    labels = set()
+    java_files = []
 
     if branch.lower().startswith("conflict"):
-        EXPECTED_LABELS.add("conflict")
+        labels.add("conflict")
 
     for status, file in files:
         if status == "D":
             continue
 
-        if file.endswith(".impex"):
-            has_impex = True
-        if file.endswith("-items.xml"):
-            has_items = True
-        if file.endswith(".java"):
-            try:
-                with open(file, encoding="utf-8", errors="ignore") as f:
-                    content = f.read()
-                    if re.search(r"@cacheable|@cacheble", content, re.IGNORECASE):
-                        has_cache = True
-            except:
-                continue
-
-    if has_impex:
-        EXPECTED_LABELS.add("IMPEX")
-    if has_items:
-        EXPECTED_LABELS.add("ITEMS")
-    if has_cache:
-        EXPECTED_LABELS.add("CACHE")
-
-def extract_issue_keys(base_branch):
-    issue_keys = set()
-    issue_keys.update(re.findall(r"[A-Z]{2,6}-\d+", branch))
-    issue_keys.update(re.findall(r"[A-Z]{2,6}-\d+", pr_title))
+        suffix = next((s for s in TRACKED_SUFFIXES if file.endswith(s)), None)
+        if suffix is None:
+            continue
+        if suffix == ".java":
+            java_files.append(file)
+        else:
+            labels.add(SUFFIX_LABELS[suffix])
 
-    result = subprocess.run(
-        ["git", "log", f"origin/{base_branch}..HEAD", "--pretty=format:%s"],
-        capture_output=True, text=True
+    if has_cache_annotation(java_files):
+        labels.add("CACHE")
+
+    return labels
+
+def extract_issue_keys(branch, pr_title, base_branch):
+    combined = "\n".join((branch, pr_title, *get_commit_subjects(base_branch)))
+    return set(_ISSUE_RE.findall(combined))
+
+def graphql(query, variables):
+    response = session.post(
+        f"{API_URL}/graphql",
+        json={"query": query, "variables": variables},
+        timeout=API_TIMEOUT
+    )
+    response.raise_for_status()
+    payload = response.json()
+    if payload.get("errors"):
+        raise RuntimeError(f"GraphQL query failed: {payload['errors']}")
+    return payload["data"]
+
+def collect_nodes(connection, query, variables, path):
+    nodes = list(connection["nodes"])
+    page_info = connection["pageInfo"]
+    while page_info["hasNextPage"]:
+        data = graphql(query, {**variables, "cursor": page_info["endCursor"]})
+        for key in path:
+            data = data[key]
+        nodes.extend(data["nodes"])
+        page_info = data["pageInfo"]
+    return nodes
+
+def fetch_pr_metadata():
+    owner, name = repo_name.split("/", 1)
+    variables = {"owner": owner, "name": name}
+
+    repository = graphql(PR_METADATA_QUERY, {**variables, "number": pr_number})["repository"]
+    pull_request = repository["pullRequest"]
+    milestone = pull_request["milestone"]
+
+    # The three connections page independently, so follow them concurrently.
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        repo_labels_future = executor.submit(
+            collect_nodes, repository["labels"], REPO_LABELS_QUERY, variables,
+            ("repository", "labels")
+        )
+        milestones_future = executor.submit(
+            collect_nodes, repository["milestones"], MILESTONES_QUERY, variables,
+            ("repository", "milestones")
+        )
+        current_labels_future = executor.submit(
+            collect_nodes, pull_request["labels"], PR_LABELS_QUERY, {**variables, "number": pr_number},
+            ("repository", "pullRequest", "labels")
+        )
+
+        repo_labels = repo_labels_future.result()
+        milestones = milestones_future.result()
+        current_labels = current_labels_future.result()
+
+    return {
+        "current_labels": {node["name"] for node in current_labels},
+        "current_milestone": milestone["title"] if milestone else None,
+        "repo_labels": {node["name"] for node in repo_labels},
+        "milestones": {node["title"]: node["number"] for node in milestones}
+    }
+
+def set_milestone_via_api(milestone_number):
+    response = session.patch(
+        f"{API_URL}/repos/{repo_name}/issues/{pr_number}",
+        json={"milestone": milestone_number},
+        timeout=API_TIMEOUT
     )
-    for msg in result.stdout.strip().splitlines():
-        issue_keys.update(re.findall(r"[A-Z]{2,6}-\d+", msg))
+    response.raise_for_status()
 
-    EXPECTED_LABELS.update(issue_keys)
+def add_labels_via_api(labels):
+    response = session.post(
+        f"{API_URL}/repos/{repo_name}/issues/{pr_number}/labels",
+        json={"labels": labels},
+        timeout=API_TIMEOUT
+    )
+    response.raise_for_status()
 
-def set_milestone(pr, repo):
-    base_branch = pr.base.ref
+def remove_label_via_api(label):
+    response = session.delete(
+        f"{API_URL}/repos/{repo_name}/issues/{pr_number}/labels/{quote(label, safe='')}",
+        timeout=API_TIMEOUT
+    )
+    response.raise_for_status()
+
+def set_milestone(repo, base_branch, milestones, current_milestone):
     milestone_name = None
 
     if base_branch.startswith("development"):
@@ -88,78 +268,60 @@ def set_milestone(pr, repo):
 
     print(f"🎯 Target milestone: {milestone_name}")
 
-    milestones = list(repo.get_milestones(state="all"))
-    target_milestone = None
-
-    for milestone in milestones:
-        if milestone.title == milestone_name:
-            target_milestone = milestone
-            break
+    target_milestone = milestones.get(milestone_name)
 
     if not target_milestone:
         try:
             print(f"🆕 Creating new milestone: {milestone_name}")
-            target_milestone = repo.create_milestone(title=milestone_name)
+            target_milestone = repo.create_milestone(title=milestone_name).number
         except Exception as e:
             print(f"❌ Failed to create milestone {milestone_name}: {e}")
             return
 
     try:
-        if pr.milestone and pr.milestone.title == milestone_name:
+        if current_milestone == milestone_name:
             print(f"ℹ️ Milestone {milestone_name} already set")
         else:
             print(f"📌 Setting milestone: {milestone_name}")
-            issue = repo.get_issue(pr.number)
-            issue.edit(milestone=target_milestone)  
+            set_milestone_via_api(target_milestone)
     except Exception as e:
         import traceback
         print(f"❌ Failed to set milestone {milestone_name}: {e}")
         traceback.print_exc()
 
-def sync_labels(pr, repo):
-    current_labels = {label.name for label in pr.get_labels()}
-    repo_labels = {label.name for label in repo.get_labels()}
-
-    for label in EXPECTED_LABELS:
-        if re.match(r"[A-Z]{2,6}-\d+", label):
+def sync_labels(repo, expected_labels, current_labels, repo_labels):
+    for label in expected_labels:
+        if _ISSUE_RE.match(label):
             try:
                 if label not in repo_labels:
                     print(f"🏷️ Creating missing issue label: {label}")
                     repo.create_label(name=label, color="ededed")
+                    repo_labels.add(label)
             except Exception as e:
                 if "already_exists" in str(e):
                     print(f"ℹ️ Label {label} already exists.")
+                    repo_labels.add(label)
                 else:
                     print(f"❌ Failed to create label {label}: {e}")
 
-    repo_labels = {label.name for label in repo.get_labels()}
+    to_add = (expected_labels - current_labels) & repo_labels
+    to_remove = (current_labels & SYSTEM_LABELS) - expected_labels
 
-    to_add = EXPECTED_LABELS - current_labels
-    to_add = [label for label in to_add if label in repo_labels]
-
-    print("📌 Will add labels:", to_add)
-    for label in to_add:
+    if to_add:
+        print(f"📌 Will add labels: {sorted(to_add)}")
         try:
-            print(f"➕ Adding label: {label}")
-            pr.add_to_labels(label)
+            add_labels_via_api(sorted(to_add))
         except Exception as e:
-            print(f"❌ Failed to add label {label}: {e}")
+            print(f"❌ Failed to add labels: {e}")
 
-    system_labels = {"IMPEX", "CACHE", "ITEMS", "conflict"}
-    to_remove = current_labels.intersection(system_labels) - EXPECTED_LABELS
     for label in to_remove:
         try:
             print(f"➖ Removing label: {label}")
-            pr.remove_from_labels(label)
+            remove_label_via_api(label)
         except Exception as e:
             print(f"⚠️ Failed to remove label {label}: {e}")
 
 def main():
-    g = Github(token)
-    repo = g.get_repo(repo_name)
-    pr = repo.get_pull(pr_number)
-    base_branch = pr.base.ref
-
     print(f"📌 PR#{pr_number} is targeting base branch: {base_branch}")
     
     ALLOWED_BASES = [
@@ -172,11 +334,19 @@ def main():
         print(f"⛔ Base branch '{base_branch}' is not allowed for labeling or milestone. Skipping all actions.")
         return
 
-    files = get_changed_files(base_branch)
-    check_label_conditions(files)
-    extract_issue_keys(base_branch)
-    sync_labels(pr, repo)
-    set_milestone(pr, repo)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        metadata_future = executor.submit(fetch_pr_metadata)
+
+        files = get_changed_files(base_branch)
+        expected_labels = check_label_conditions(files, branch) | extract_issue_keys(branch, pr_title, base_branch)
+
+        metadata = metadata_future.result()
+
+    g = Github(token)
+    repo = g.get_repo(repo_name, lazy=True)
+
+    sync_labels(repo, expected_labels, metadata["current_labels"], metadata["repo_labels"])
+    set_milestone(repo, base_branch, metadata["milestones"], metadata["current_milestone"])
 
 if __name__ == "__main__":
     main()